@@ -1,39 +1,89 @@
+import os
+import sys
 import time
 
+import machine
 import mip
 import network
 
 from config import WIFI_PASS, WIFI_SSID
 
+WIFI_TIMEOUT_MS = 20000
+WIFI_RETRIES = 5
 
-def connect_network():
-    wlan = network.WLAN(network.STA_IF)
-    wlan.active(True)
 
+def _activate(wlan):
+    wlan.active(True)
     try:
         wlan.config(pm=0xA11140)
     except:
         pass
 
-    if not wlan.isconnected():
-        print("Connecting to WiFi...")
-        wlan.connect(WIFI_SSID, WIFI_PASS)
-        while not wlan.isconnected():
-            time.sleep(0.5)
-    print("WiFi Connected:", wlan.ifconfig())
+
+def connect_network():
+    wlan = network.WLAN(network.STA_IF)
+    _activate(wlan)
+
+    backoff = 1
+    for _ in range(WIFI_RETRIES):
+        if not wlan.isconnected():
+            print("Connecting to WiFi...")
+            wlan.connect(WIFI_SSID, WIFI_PASS)
+
+        deadline = time.ticks_add(time.ticks_ms(), WIFI_TIMEOUT_MS)
+        status = wlan.status()
+        while time.ticks_diff(deadline, time.ticks_ms()) > 0:
+            status = wlan.status()
+            if status == network.STAT_GOT_IP or wlan.isconnected():
+                print("WiFi Connected:", wlan.ifconfig())
+                return
+            if status in (network.STAT_NO_AP_FOUND, network.STAT_WRONG_PASSWORD):
+                break
+            time.sleep_ms(100)
+
+        print("WiFi failed (status %d), retrying in %ds..." % (status, backoff))
+        wlan.active(False)
+        time.sleep(backoff)
+        _activate(wlan)
+        backoff *= 2
+
+    print("WiFi unavailable. Rebooting...")
+    machine.reset()
+
+
+def _is_installed(import_name):
+    if import_name in sys.modules:
+        return True
+    path = "/lib/" + import_name.replace(".", "/")
+    for suffix in (".mpy", ".py", "/__init__.mpy", "/__init__.py"):
+        try:
+            os.stat(path + suffix)
+            return True
+        except OSError:
+            pass
+    return False
 
 
 def install_dependencies():
-    libs = [("umqtt.robust", "umqtt.robust"), ("hmac", "hmac"), ("hashlib", "hashlib")]
+    libs = [
+        ("umqtt.robust", "umqtt.robust"),
+        ("hashlib", "hashlib"),
+        ("cbor2", "cbor2"),
+    ]
     for import_name, install_name in libs:
+        if _is_installed(import_name):
+            continue
         try:
+            # Not on flash; may still be built into the firmware (e.g. hashlib).
             __import__(import_name)
+            continue
         except ImportError:
-            print(f"Installing {install_name}...")
-            try:
-                mip.install(install_name)
-            except Exception as e:
-                print(f"Error: {e}")
+            pass
+        print(f"Installing {install_name}...")
+        try:
+            mip.install(install_name)
+        except Exception as e:
+            print(f"Error: {e}")
 
 
 connect_network()
@@ -1,4 +1,4 @@
-VERSION = "1.3.0"
+VERSION = "1.4.0"
 
 WIFI_SSID = "WiFi-SSID"
 WIFI_PASS = "WIFI_PASSWORD"
@@ -18,4 +18,7 @@ WOL_PORT = 9
 LED_PIN = 2
 LED_SIGNALS = True
 
-TIMETABLE_FILE = "timetable.json"
+# Verbose per-message logging over UART. Keep off in production.
+DEBUG = False
+
+TIMETABLE_FILE = "timetable.cbor"
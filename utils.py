@@ -1,5 +1,5 @@
+import gc
 import hashlib
-import hmac
 import json
 import os
 import select
@@ -7,12 +7,16 @@ import socket
 import struct
 import time
 
+import cbor2
 import machine
+import micropython
+import network
 import ntptime
 import ubinascii
-import ucryptolib
+from micropython import const
 
 from config import (
+    DEBUG,
     DEVICE_SERIAL,
     SECRET_KEY,
     TIMETABLE_FILE,
@@ -22,57 +26,134 @@ from config import (
     WOL_PORT,
 )
 
+try:
+    import cryptolib
+except ImportError:
+    import ucryptolib as cryptolib
+
+_AES_MODE_CBC = const(2)
+# PKCS#7 pad bytes indexed by pad length (1-16); entry 0 is never used.
+_PKCS7_PADS = tuple(bytes((n,)) * n for n in range(17))
+_LEGACY_TIMETABLE_FILE = "timetable.json"
+
+# Key material derived from SECRET_KEY once, instead of per CryptoManager/message.
+_SECRET_BYTES = SECRET_KEY.encode()
+_CIPHER_KEY = hashlib.sha256(_SECRET_BYTES).digest()
+
+
+def _hmac_pad(value):
+    # HMAC-SHA256 (RFC 2104) key pad: key hashed if longer than a block, then padded.
+    key = _CIPHER_KEY if len(_SECRET_BYTES) > 64 else _SECRET_BYTES
+    key = key + b"\x00" * (64 - len(key))
+    return bytes(b ^ value for b in key)
+
+
+_IPAD = _hmac_pad(0x36)
+_OPAD = _hmac_pad(0x5C)
+
+
+@micropython.native
+def _compare_digest(a, b):
+    # Constant time: XOR-OR over the whole buffer, no early exit on mismatch.
+    if len(a) != len(b):
+        return False
+    diff = 0
+    for i in range(len(a)):
+        diff |= a[i] ^ b[i]
+    return diff == 0
+
+
+_WOL_MAC_BYTES = ubinascii.unhexlify(WOL_MAC.replace(":", "").replace("-", ""))
+_WOL_PAYLOAD = b"\xff" * 6 + _WOL_MAC_BYTES * 16
+
 
 class CryptoManager:
     """
     <summary>Handles AES encryption/decryption and HMAC signature verification.</summary>
     """
 
-    def __init__(self):
-        self.key = hashlib.sha256(SECRET_KEY.encode()).digest()
+    BUF_SIZE = 256
 
-    def _pad(self, data):
-        block_size = 16
-        padding = block_size - len(data) % block_size
-        return data + (chr(padding) * padding).encode()
+    def __init__(self):
+        self.key = _CIPHER_KEY
+        # cryptolib is backed by mbedtls, which drives the ESP32 AES peripheral.
+        # Fixed RX/TX buffers keep each message from allocating (and
+        # fragmenting the heap with) its own output buffer.
+        self._rx = bytearray(self.BUF_SIZE)
+        self._tx = bytearray(self.BUF_SIZE)
+        self._rx_mv = memoryview(self._rx)
+        self._tx_mv = memoryview(self._tx)
 
     def _unpad(self, data):
         return data[: -data[-1]]
 
+    def _out_buffer(self, mv, size):
+        if size <= self.BUF_SIZE:
+            return mv[:size]
+        return memoryview(bytearray(size))
+
     def encrypt(self, plaintext):
+        """
+        Encrypts plaintext into the TX buffer.
+        Returns the raw IV + ciphertext as bytes, or b"" on failure.
+        """
         try:
+            data = plaintext.encode()
+            size = len(data)
+            padding = 16 - size % 16
+            out = self._out_buffer(self._tx_mv, 16 + size + padding)
             iv = os.urandom(16)
-            cipher = ucryptolib.aes(self.key, 2, iv)
-            encrypted = cipher.encrypt(self._pad(plaintext.encode()))
-            return (
-                ubinascii.hexlify(iv) + b":" + ubinascii.hexlify(encrypted)
-            ).decode()
+            out[:16] = iv
+            out[16 : 16 + size] = data
+            out[16 + size :] = _PKCS7_PADS[padding]
+            body = out[16:]
+            cipher = cryptolib.aes(self.key, _AES_MODE_CBC, iv)
+            cipher.encrypt(body, body)
+            return bytes(out)
         except Exception as e:
             print("[SEC] Encryption error:", e)
-            return ""
+            return b""
 
-    def decrypt(self, encrypted_str):
+    def decrypt(self, data):
+        """
+        Decrypts a raw IV + ciphertext MQTT payload into the RX buffer.
+        Returns the plaintext as bytes, or None on failure.
+        """
         try:
-            parts = encrypted_str.split(":")
-            if len(parts) != 2:
+            size = len(data) - 16
+            if size <= 0 or size % 16:
                 return None
-            iv = ubinascii.unhexlify(parts[0])
-            ciphertext = ubinascii.unhexlify(parts[1])
-            cipher = ucryptolib.aes(self.key, 2, iv)
-            return self._unpad(cipher.decrypt(ciphertext)).decode()
+            mv = memoryview(data)
+            out = self._out_buffer(self._rx_mv, size)
+            cipher = cryptolib.aes(self.key, _AES_MODE_CBC, mv[:16])
+            cipher.decrypt(mv[16:], out)
+            return bytes(self._unpad(out))
         except:
-            print("[SEC] Decryption failed: format/key error")
+            if DEBUG:
+                print("[SEC] Decryption failed: format/key error")
             return None
 
+    def _mac(self, cmd, timestamp):
+        # hashlib runs on the ESP32 SHA peripheral through mbedtls, so with the
+        # pads precomputed an HMAC is just two hashes.
+        inner = hashlib.sha256(_IPAD)
+        inner.update(cmd)
+        inner.update(timestamp)
+        outer = hashlib.sha256(_OPAD)
+        outer.update(inner.digest())
+        return outer.digest()
+
     def verify_signature(self, cmd, timestamp, signature):
+        """
+        Checks the hex HMAC-SHA256 of cmd + timestamp against signature.
+        All three arguments may be bytes or memoryview slices.
+        """
         try:
-            check_str = cmd + timestamp
-            calc_sig = hmac.new(
-                SECRET_KEY.encode(), check_str.encode(), hashlib.sha256
-            ).hexdigest()
-            match = calc_sig == signature
-            if not match:
-                print("[SEC] Signature mismatch:", cmd)
+            match = _compare_digest(
+                self._mac(cmd, timestamp), ubinascii.unhexlify(signature)
+            )
+            if not match and DEBUG:
+                print("[SEC] Signature mismatch:", bytes(cmd))
             return match
         except:
             return False
@@ -83,11 +164,17 @@ class SystemTools:
     <summary>Utility class for system time, topic generation, and metrics.</summary>
     """
 
+    # The dynamic topic embeds the UTC hour, so it only changes once per period.
+    TOPIC_PERIOD = 3600
+    NTP_HOST = "pool.ntp.org"
+    # Seconds between the Unix epoch (1970) and MicroPython's epoch (2000).
+    EPOCH_OFFSET = 946684800
+
     @staticmethod
     def sync_time():
-        print("[NTP] Syncing with pool.ntp.org...")
+        print("[NTP] Syncing with %s..." % SystemTools.NTP_HOST)
         try:
-            ntptime.host = "pool.ntp.org"
+            ntptime.host = SystemTools.NTP_HOST
             ntptime.settime()
             print("[NTP] Success. UTC:", time.gmtime())
             return True
@@ -103,10 +190,6 @@ class SystemTools:
 
     @staticmethod
     def get_metrics(start_time):
-        import gc
-
-        import network
-
         gc.collect()
 
         try:
@@ -137,22 +220,37 @@ class SystemTools:
 
 class ScheduleManager:
     """
-    <summary>Manages timetable.json reading/writing and wake checks.</summary>
+    <summary>Manages the CBOR timetable file, an in-memory copy, and wake checks.</summary>
     """
 
+    _cache = None
+
     @staticmethod
-    def load_schedule():
+    def _read_schedule():
+        try:
+            with open(TIMETABLE_FILE, "rb") as f:
+                return cbor2.loads(f.read())
+        except:
+            pass
+        # Schedules saved by v1.3.0 and earlier are JSON.
         try:
-            with open(TIMETABLE_FILE, "r") as f:
+            with open(_LEGACY_TIMETABLE_FILE, "r") as f:
                 return json.load(f)
         except:
             return {"offset": 0, "days": {}}
 
+    @staticmethod
+    def load_schedule():
+        if ScheduleManager._cache is None:
+            ScheduleManager._cache = ScheduleManager._read_schedule()
+        return ScheduleManager._cache
+
     @staticmethod
     def save_schedule(data):
         try:
-            with open(TIMETABLE_FILE, "w") as f:
-                json.dump(data, f)
+            with open(TIMETABLE_FILE, "wb") as f:
+                f.write(cbor2.dumps(data))
+            ScheduleManager._cache = data
             return True
         except Exception as e:
             print("[SCHED] Save error:", e)
@@ -185,62 +283,137 @@ class ScheduleManager:
         return False
 
 
+class RingQueue:
+    """
+    <summary>Fixed-size single-producer/single-consumer queue. Size must be a power of two.</summary>
+    """
+
+    def __init__(self, size):
+        self._slots = [None] * size
+        self._size = size
+        self._mask = size - 1
+        self._wrap = 2 * size - 1
+        self._head = 0
+        self._tail = 0
+
+    def push(self, item):
+        if (self._head - self._tail) & self._wrap == self._size:
+            return False
+        self._slots[self._head & self._mask] = item
+        self._head = (self._head + 1) & self._wrap
+        return True
+
+    def pop(self):
+        if self._head == self._tail:
+            return None
+        idx = self._tail & self._mask
+        item = self._slots[idx]
+        self._slots[idx] = None
+        self._tail = (self._tail + 1) & self._wrap
+        return item
+
+
 class WOLService:
     """
     <summary>Provides network services for Wake-on-LAN and ICMP Ping.</summary>
     """
 
+    _wol_sock = None
+    _wol_dest = (WOL_IP, WOL_PORT)
+
+    _ping_sock = None
+    _ping_addrs = {}
+    # ICMP echo request: 8-byte header (type 8, id 0x1234, seq 1) + 8-byte timestamp.
+    _ping_packet = bytearray(struct.pack("!BBHHH", 8, 0, 0, 0x1234, 1) + bytes(8))
+
     @staticmethod
-    def send_magic_packet():
-        print(f"[WOL] Targeting {WOL_MAC}...")
-        try:
-            mac_bytes = ubinascii.unhexlify(WOL_MAC.replace(":", "").replace("-", ""))
-            payload = b"\xff" * 6 + mac_bytes * 16
+    def _get_wol_socket():
+        if WOLService._wol_sock is None:
             sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
             sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
-            sock.sendto(payload, (WOL_IP, WOL_PORT))
-            sock.close()
-            print("[WOL] Sent.")
+            WOLService._wol_sock = sock
+        return WOLService._wol_sock
+
+    @staticmethod
+    def _close_wol_socket():
+        if WOLService._wol_sock:
+            try:
+                WOLService._wol_sock.close()
+            except:
+                pass
+            WOLService._wol_sock = None
+
+    @staticmethod
+    def send_magic_packet():
+        if DEBUG:
+            print("[WOL] Targeting %s..." % WOL_MAC)
+        try:
+            sock = WOLService._get_wol_socket()
+            sock.sendto(_WOL_PAYLOAD, WOLService._wol_dest)
+            if DEBUG:
+                print("[WOL] Sent.")
         except Exception as e:
             print("[WOL] Error:", e)
+            # Reopen on the next call in case the socket went stale (WiFi drop).
+            WOLService._close_wol_socket()
 
     @staticmethod
+    @micropython.native
     def _get_checksum(source):
-        checksum = 0
-        count = (len(source) // 2) * 2
-        i = 0
-        while i < count:
-            checksum += source[i + 1] * 256 + source[i]
-            checksum &= 0xFFFFFFFF
-            i += 2
-        if i < len(source):
-            checksum += source[len(source) - 1]
-            checksum &= 0xFFFFFFFF
-        checksum = (checksum >> 16) + (checksum & 0xFFFF)
-        checksum += checksum >> 16
-        answer = ~checksum & 0xFFFF
-        return answer >> 8 | (answer << 8 & 0xFF00)
+        # RFC 1071 sum over network-order (big-endian) 16-bit words, so the
+        # result is already in the byte order it is packed with ("!H").
+        n = len(source)
+        checksum = sum(struct.unpack_from("!%dH" % (n // 2), source))
+        if n & 1:
+            checksum += source[n - 1] << 8
+        while checksum >> 16:
+            checksum = (checksum & 0xFFFF) + (checksum >> 16)
+        return ~checksum & 0xFFFF
 
     @staticmethod
-    def ping_device(host):
-        print(f"[PING] {host}...")
-        sock = None
-        try:
+    def _get_ping_socket():
+        if WOLService._ping_sock is None:
             sock = socket.socket(socket.AF_INET, socket.SOCK_RAW, 1)
             sock.settimeout(2.0)
-            header = struct.pack("!BBHHH", 8, 0, 0, 0x1234, 1)
-            data = struct.pack("d", time.time())
-            chk = WOLService._get_checksum(header + data)
-            header = struct.pack("!BBHHH", 8, 0, chk, 0x1234, 1)
-            addr = socket.getaddrinfo(host, 1)[0][-1]
-            sock.sendto(header + data, addr)
+            WOLService._ping_sock = sock
+        return WOLService._ping_sock
+
+    @staticmethod
+    def _close_ping_socket():
+        if WOLService._ping_sock:
+            try:
+                WOLService._ping_sock.close()
+            except:
+                pass
+            WOLService._ping_sock = None
+
+    @staticmethod
+    def ping_device(host):
+        if DEBUG:
+            print("[PING] %s..." % host)
+        try:
+            sock = WOLService._get_ping_socket()
+            addr = WOLService._ping_addrs.get(host)
+            if addr is None:
+                addr = socket.getaddrinfo(host, 1)[0][-1]
+                WOLService._ping_addrs[host] = addr
+
+            # The socket is reused, so drop replies that arrived after an
+            # earlier ping had already timed out.
+            while select.select([sock], [], [], 0)[0]:
+                sock.recv(64)
+
+            packet = WOLService._ping_packet
+            struct.pack_into("!H", packet, 2, 0)
+            struct.pack_into("d", packet, 8, time.time())
+            struct.pack_into("!H", packet, 2, WOLService._get_checksum(packet))
+            sock.sendto(packet, addr)
             ready = select.select([sock], [], [], 2.0)
             result = True if ready[0] else False
-            print(f"[PING] Result: {'ONLINE' if result else 'OFFLINE'}")
+            if DEBUG:
+                print("[PING] Result: %s" % ("ONLINE" if result else "OFFLINE"))
             return result
         except Exception as e:
             print("[PING] Error:", e)
+            WOLService._close_ping_socket()
             return False
-        finally:
-            if sock:
-                sock.close()
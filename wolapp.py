@@ -0,0 +1,380 @@
+import _thread
+import gc
+import json
+import select
+import time
+
+import machine
+import micropython
+from micropython import const
+from umqtt.robust import MQTTClient
+
+import config
+from utils import (
+    CryptoManager,
+    RingQueue,
+    ScheduleManager,
+    SystemTools,
+    WOLService,
+)
+
+
+@micropython.viper
+def _atoi(buf: ptr8, n: int) -> int:
+    # Parses n ASCII digits without int()'s generic (allocating) parser.
+    # Returns -1 if any byte is not a digit.
+    r: int = 0
+    i: int = 0
+    while i < n:
+        c = int(buf[i]) - 48
+        if c < 0 or c > 9:
+            return -1
+        r = r * 10 + c
+        i += 1
+    return r
+
+
+class BackgroundService:
+    """
+    <summary>Runs on Core 0. Handles LED blinking and Schedule checks.</summary>
+    """
+
+    BOOT = const(0)
+    CONNECTING = const(1)
+    ERROR = const(2)
+    IDLE = const(3)
+
+    # Blink interval (ms) per mode, indexed by mode. IDLE uses IDLE_ON/IDLE_OFF.
+    INTERVALS = (100, 300, 50)
+    IDLE_ON = const(50)
+    IDLE_OFF = const(4000)
+
+    MODE_POLL = const(250)
+    SCHED_INTERVAL = const(10000)
+
+    def __init__(self):
+        self.enabled_led = config.LED_SIGNALS
+        self.led_pin = None
+        self.mode = self.BOOT
+        self.state = 0
+        self.last_wake_min = -1
+
+        if self.enabled_led:
+            try:
+                self.led_pin = machine.Pin(config.LED_PIN, machine.Pin.OUT)
+                self.led_pin.value(0)
+            except:
+                self.enabled_led = False
+
+    def set_mode(self, mode):
+        self.mode = mode
+
+    def flash(self, count):
+        if not self.enabled_led:
+            return
+        for _ in range(count):
+            self.led_pin.value(1)
+            time.sleep(0.05)
+            self.led_pin.value(0)
+            time.sleep(0.05)
+
+    @micropython.native
+    def _run_thread(self):
+        last_led_tick = 0
+        last_sched_tick = 0
+
+        while True:
+            now = time.ticks_ms()
+            wait = self.MODE_POLL
+
+            if self.enabled_led:
+                mode = self.mode
+                if mode < self.IDLE:
+                    interval = self.INTERVALS[mode]
+                else:
+                    interval = self.IDLE_ON if self.state else self.IDLE_OFF
+
+                elapsed = time.ticks_diff(now, last_led_tick)
+                if elapsed >= interval:
+                    self.state = 1 - self.state
+                    self.led_pin.value(self.state)
+                    last_led_tick = now
+                    elapsed = 0
+                wait = min(wait, interval - elapsed)
+
+            elapsed = time.ticks_diff(now, last_sched_tick)
+            if elapsed >= self.SCHED_INTERVAL:
+                last_sched_tick = now
+                elapsed = 0
+                try:
+                    t = time.gmtime()
+                    current_min = t[4]
+
+                    if current_min != self.last_wake_min:
+                        if ScheduleManager.should_wake():
+                            print("[SCHED] Triggering Auto-Wake")
+                            WOLService.send_magic_packet()
+                            self.flash(3)
+                            self.last_wake_min = current_min
+                except Exception as e:
+                    print("[SCHED] Thread Error:", e)
+            wait = min(wait, self.SCHED_INTERVAL - elapsed)
+
+            # Sleep until the next LED toggle or schedule check is due instead
+            # of waking every few ms; mode changes are picked up within MODE_POLL.
+            time.sleep_ms(max(wait, 1))
+
+    def start(self):
+        _thread.start_new_thread(self._run_thread, ())
+
+
+class WOLApp:
+    """
+    <summary>Main Logic on Core 1. Manages MQTT and system integrity.</summary>
+    """
+
+    RX_QUEUE_LEN = const(8)
+    MAX_CMD_LEN = const(160)
+    REBOOT_AFTER = const(43200)
+    # umqtt never sends PINGREQ by itself; ping at half the keepalive, but only
+    # when nothing else was sent, since any outgoing packet resets the broker timer.
+    MQTT_KEEPALIVE = const(60)
+    PING_INTERVAL = const(30)
+    RX_WAIT_MS = const(200)
+
+    def __init__(self):
+        self.service = BackgroundService()
+        self.crypto = CryptoManager()
+        self.client = None
+        self.rx_queue = RingQueue(self.RX_QUEUE_LEN)
+        self.current_topic = ""
+        self.resp_topic = ""
+        self.topic_epoch = -1
+        self.start_time = 0
+        self.reboot_at = 0
+        self.next_ping = 0
+        self.wdt = None
+        self.poller = select.poll()
+        self.polled_sock = None
+        self.commands = {
+            b"WAKE": self._do_wake,
+            b"STATUS": self._do_status,
+            b"PING": self._do_ping,
+            b"USAGE": self._do_usage,
+            b"GET_SCHED": self._do_get_sched,
+        }
+
+    def _setup_wdt(self):
+        print("[SYS] Initializing Watchdog (15s)...")
+        try:
+            self.wdt = machine.WDT(timeout=15000)
+        except:
+            print("[SYS] WDT not available.")
+
+    def _feed(self):
+        if self.wdt:
+            self.wdt.feed()
+
+    def _wait_for_rx(self, timeout_ms):
+        # Block in poll() rather than sleeping: the task yields to FreeRTOS and
+        # wakes as soon as the broker sends data. umqtt.robust replaces the
+        # socket on reconnect, so re-register whenever it changes.
+        sock = self.client.sock
+        if sock is not self.polled_sock:
+            if self.polled_sock is not None:
+                try:
+                    self.poller.unregister(self.polled_sock)
+                except:
+                    pass
+            self.poller.register(sock, select.POLLIN)
+            self.polled_sock = sock
+        self.poller.poll(timeout_ms)
+
+    def _on_message(self, topic, msg):
+        # Keep the MQTT read path short: queue the raw payload and let the
+        # main loop handle it once check_msg() has returned.
+        if not self.rx_queue.push(msg) and config.DEBUG:
+            print("[MQTT] RX queue full, dropping message")
+
+    def _process_queue(self):
+        msg = self.rx_queue.pop()
+        while msg is not None:
+            self._handle_message(msg)
+            self._feed()
+            msg = self.rx_queue.pop()
+
+    def _handle_message(self, msg):
+        current_ts = time.time() + SystemTools.EPOCH_OFFSET
+        self.service.flash(1)
+        try:
+            decrypted = self.crypto.decrypt(msg)
+            if not decrypted:
+                return
+
+            # Packet layout is "<cmd>|<ts>|<sig>"; cmd itself may contain "|".
+            i2 = decrypted.rfind(b"|")
+            if i2 < 0:
+                return
+            i1 = decrypted.rfind(b"|", 0, i2)
+            if i1 < 0:
+                return
+
+            mv = memoryview(decrypted)
+            cmd = mv[:i1]
+            ts_bytes = mv[i1 + 1 : i2]
+            sig = mv[i2 + 1 :]
+
+            # Cheap format and freshness checks run before the HMAC, so a flood
+            # of garbage or replayed packets never reaches SHA-256.
+            ts_len = len(ts_bytes)
+            if len(sig) != 64 or not 0 < ts_len <= 10 or len(cmd) > self.MAX_CMD_LEN:
+                return
+
+            ts = _atoi(ts_bytes, ts_len)
+            if ts < 0:
+                return
+
+            skew = current_ts - ts
+            if skew < 0:
+                skew = -skew
+            if skew > 120:
+                if config.DEBUG:
+                    print("[ERR] Time skew: %ds" % skew)
+                return
+
+            if not self.crypto.verify_signature(cmd, ts_bytes, sig):
+                return
+
+            command = bytes(cmd)
+            handler = self.commands.get(command)
+            if handler:
+                handler()
+            elif command.startswith(b"{"):
+                self._do_json(command)
+
+        except Exception as e:
+            print("[ERR] Handler error:", e)
+
+    def _do_wake(self):
+        if config.DEBUG:
+            print("[OK] Manual Wake")
+        WOLService.send_magic_packet()
+        self.service.flash(3)
+
+    def _do_status(self):
+        status = "ONLINE" if WOLService.ping_device(config.WOL_IP) else "OFFLINE"
+        self._publish(self.resp_topic, status)
+        self.service.flash(2)
+
+    def _do_ping(self):
+        self._publish(self.resp_topic, "PONG")
+
+    def _do_usage(self):
+        metrics = SystemTools.get_metrics(self.start_time)
+        self._publish(self.resp_topic, metrics)
+
+    def _do_get_sched(self):
+        data = ScheduleManager.load_schedule()
+        self._publish(self.resp_topic, json.dumps(data))
+
+    def _do_json(self, command):
+        try:
+            payload = json.loads(command.decode())
+            if payload.get("cmd") == "SET_SCHED":
+                if ScheduleManager.save_schedule(payload.get("data")):
+                    self._publish(self.resp_topic, "SCHED_SAVED")
+                    print("[SCHED] Updated")
+        except ValueError:
+            pass
+
+    def _set_topic(self, topic):
+        self.current_topic = topic
+        self.resp_topic = topic + "/response"
+
+    def _publish(self, topic, payload):
+        enc = self.crypto.encrypt(payload)
+        if enc:
+            self.client.publish(topic, enc)
+            self.next_ping = time.time() + self.PING_INTERVAL
+
+    def _connect_mqtt(self):
+        print(f"[MQTT] Connecting to {config.MQTT_BROKER}...")
+        self.service.set_mode(BackgroundService.CONNECTING)
+        self.client = MQTTClient(
+            config.MQTT_CLIENT_ID,
+            config.MQTT_BROKER,
+            port=config.MQTT_PORT,
+            keepalive=self.MQTT_KEEPALIVE,
+        )
+        self.client.set_callback(self._on_message)
+        self.client.connect()
+        self._set_topic(SystemTools.get_dynamic_topic())
+        self.topic_epoch = time.time() // SystemTools.TOPIC_PERIOD
+        self.client.subscribe(self.current_topic)
+        print(f"[MQTT] Subscribed: {self.current_topic}")
+        self.service.set_mode(BackgroundService.IDLE)
+
+    def run(self):
+        print(f"--- ESP32 WOL v{config.VERSION} ---")
+        self.service.start()
+        self._setup_wdt()
+        gc.enable()
+        # Collect once ~25% of the currently free heap has been allocated,
+        # instead of waiting for an allocation to fail.
+        gc.threshold(gc.mem_free() // 4 + gc.mem_alloc())
+
+        if not SystemTools.sync_time():
+            print("[CRIT] No NTP. Rebooting...")
+            time.sleep(5)
+            machine.reset()
+
+        self.start_time = time.time()
+        self.reboot_at = self.start_time + self.REBOOT_AFTER
+        self.next_ping = self.start_time + self.PING_INTERVAL
+
+        try:
+            self._connect_mqtt()
+        except Exception as e:
+            print("[CRIT] Init Error:", e)
+            self.service.set_mode(BackgroundService.ERROR)
+            time.sleep(10)
+            machine.reset()
+
+        print("[SYS] Entering Main Loop (Core 1).")
+        while True:
+            self._feed()
+            try:
+                now = time.time()
+                if now >= self.reboot_at:
+                    print("[SYS] Maintenance reboot.")
+                    machine.reset()
+
+                self.client.check_msg()
+                self._process_queue()
+
+                epoch = now // SystemTools.TOPIC_PERIOD
+                if epoch != self.topic_epoch:
+                    self.topic_epoch = epoch
+                    new_topic = SystemTools.get_dynamic_topic()
+                    if new_topic != self.current_topic:
+                        if config.DEBUG:
+                            print("[MQTT] Rotating...")
+                        try:
+                            self.client.unsubscribe(self.current_topic)
+                        except:
+                            pass
+                        self._set_topic(new_topic)
+                        self.client.subscribe(self.current_topic)
+                        SystemTools.sync_time()
+
+                if now >= self.next_ping:
+                    self.client.ping()
+                    self.next_ping = now + self.PING_INTERVAL
+
+                self._wait_for_rx(self.RX_WAIT_MS)
+
+            except Exception as e:
+                print(f"[ERR] Runtime Loop: {e}")
+                self.service.set_mode(BackgroundService.ERROR)
+                time.sleep(10)
+                machine.reset()